@@ -9,8 +9,8 @@ use std::convert::TryInto;
 
 use anyhow::{format_err, Result};
 use cpython::{
-    PyBytes, PyDict, PyIterator, PyList, PyObject, PyResult, PyTuple, Python, PythonObject,
-    ToPyObject,
+    exc, PyBytes, PyDict, PyErr, PyIterator, PyList, PyObject, PyResult, PySequence, PyTuple,
+    Python, PythonObject, ToPyObject,
 };
 
 use cpython_ext::{PyPath, PyPathBuf, ResultPyErrExt};
@@ -53,6 +53,7 @@ pub trait HgIdMutableDeltaStorePyExt: HgIdDataStorePyExt {
         delta: &PyBytes,
         metadata: Option<PyDict>,
     ) -> PyResult<PyObject>;
+    fn add_many_py(&self, py: Python, revisions: &mut PyIterator) -> PyResult<PyObject>;
     fn flush_py(&self, py: Python) -> PyResult<Option<PyPathBuf>>;
 }
 
@@ -272,6 +273,49 @@ impl<T: HgIdMutableDeltaStore + ?Sized> HgIdMutableDeltaStorePyExt for T {
         Ok(Python::None(py))
     }
 
+    fn add_many_py(&self, py: Python, revisions: &mut PyIterator) -> PyResult<PyObject> {
+        // Convert every (name, node, deltabasenode, delta[, metadata]) sequence
+        // up front so that all the adds happen in a single GIL release.
+        let revisions = revisions
+            .map(|revision| {
+                let revision = revision?.extract::<PySequence>(py)?;
+                let len = revision.len(py)?;
+                if len != 4 && len != 5 {
+                    return Err(PyErr::new::<exc::ValueError, _>(
+                        py,
+                        format!(
+                            "expected (name, node, deltabasenode, delta[, metadata]), got {} items",
+                            len
+                        ),
+                    ));
+                }
+
+                let name = revision.get_item(py, 0)?.extract::<PyPathBuf>(py)?;
+                let node = revision.get_item(py, 1)?.extract::<PyBytes>(py)?;
+                let deltabasenode = revision.get_item(py, 2)?.extract::<PyBytes>(py)?;
+                let delta = revision.get_item(py, 3)?.extract::<PyBytes>(py)?;
+                let delta = to_delta(py, &name, &node, &deltabasenode, &delta)?;
+
+                let mut metadata = Default::default();
+                if len == 5 {
+                    if let Some(meta) = revision.get_item(py, 4)?.extract::<Option<PyDict>>(py)? {
+                        metadata = to_metadata(py, &meta)?;
+                    }
+                }
+                Ok((delta, metadata))
+            })
+            .collect::<PyResult<Vec<_>>>()?;
+
+        py.allow_threads(|| -> Result<()> {
+            for (delta, metadata) in revisions.iter() {
+                self.add(delta, metadata)?;
+            }
+            Ok(())
+        })
+        .map_pyerr(py)?;
+        Ok(Python::None(py))
+    }
+
     fn flush_py(&self, py: Python) -> PyResult<Option<PyPathBuf>> {
         let opt = py.allow_threads(|| self.flush()).map_pyerr(py)?;
         let opt = opt.map(|path| path.try_into()).transpose().map_pyerr(py)?;
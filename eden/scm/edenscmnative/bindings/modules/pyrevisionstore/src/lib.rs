@@ -459,6 +459,11 @@ py_class!(pub class mutabledeltastore |py| {
         store.add_py(py, &name, node, deltabasenode, delta, metadata)
     }
 
+    def add_many(&self, revisions: &PyObject) -> PyResult<PyObject> {
+        let store = self.store(py);
+        store.add_many_py(py, &mut revisions.iter(py)?)
+    }
+
     def flush(&self) -> PyResult<Option<PyPathBuf>> {
         let store = self.store(py);
         store.flush_py(py)
@@ -2,15 +2,15 @@
 from __future__ import absolute_import, print_function
 
 import hashlib
+import multiprocessing
 import os
 import random
 import shutil
 import stat
-import struct
-import sys
 import tempfile
 import time
 import unittest
+from multiprocessing.pool import ThreadPool
 
 import edenscm.mercurial.ui as uimod
 import silenttestrunner
@@ -24,36 +24,92 @@ from hghave import require
 
 SMALLFANOUTCUTOFF = 2 ** 16 // 8
 
+# Write packs to a ramdisk when one is available, so pack flushes don't have
+# to wait on the disk. A temp location picked by the test runner or the user
+# (TMPDIR, TEMP or TMP, which tempfile honours) always wins.
+TEMPDIRBASE = None
+if (
+    not any(os.environ.get(name) for name in ("TMPDIR", "TEMP", "TMP"))
+    and os.path.isdir("/dev/shm")
+    and os.access("/dev/shm", os.W_OK)
+):
+    TEMPDIRBASE = "/dev/shm"
+
 try:
     xrange(0)
 except NameError:
     xrange = range
 
+try:
+    truncate = os.truncate
+except AttributeError:
+
+    def truncate(path, length):
+        with open(path, "r+b") as f:
+            f.truncate(length)
+
 
 class datapacktestsbase(object):
     def __init__(self, datapackreader):
         self.datapackreader = datapackreader
 
     def setUp(self):
-        self.tempdirs = []
+        # All of a test's temp dirs live under one root, so tearDown only has
+        # a single tree to remove.
+        self.temproot = tempfile.mkdtemp(dir=TEMPDIRBASE)
 
     def tearDown(self):
-        for d in self.tempdirs:
-            shutil.rmtree(d)
+        shutil.rmtree(self.temproot, ignore_errors=True)
 
     def makeTempDir(self):
-        tempdir = tempfile.mkdtemp()
-        self.tempdirs.append(tempdir)
-        return tempdir
+        return tempfile.mkdtemp(dir=self.temproot)
 
     def getHash(self, content):
         return hashlib.sha1(content).digest()
 
+    def getHashes(self, contents):
+        sha1 = hashlib.sha1
+        return [sha1(content).digest() for content in contents]
+
     def getFakeHash(self):
-        if sys.version_info[0] >= 3:
-            return bytes(random.getrandbits(8) for _ in xrange(20))
-        else:
-            return "".join(chr(random.randint(0, 255)) for _ in range(20))
+        return os.urandom(20)
+
+    def getFakeHashes(self, count):
+        buf = os.urandom(20 * count)
+        return [buf[i * 20 : (i + 1) * 20] for i in xrange(count)]
+
+    def createPackNoReopen(self, revisions, packdir):
+        """Write the revisions to a new pack in packdir and return its path,
+        without opening it."""
+        packer = revisionstore.mutabledeltastore(packfilepath=packdir)
+        # Each revision is (filename, node, base, content[, meta]).
+        packer.add_many(revisions)
+        return packer.flush()
+
+    def createPacksNoReopen(self, chains, packdir):
+        """Write each chain to its own pack in packdir, in parallel, and return
+        the pack paths in the same order as chains."""
+        # The mutabledeltastore releases the GIL while adding and flushing.
+        pool = ThreadPool(min(multiprocessing.cpu_count(), len(chains)))
+        try:
+            return pool.map(
+                lambda chain: self.createPackNoReopen(chain, packdir), chains
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+    def createFakeChain(self, filename, length):
+        """Build a delta chain of length revisions of filename, with fake
+        nodes and contents."""
+        nodes = self.getFakeHashes(length)
+        contents = [b"content"] + self.getFakeHashes(length - 1)
+        chain = []
+        base = nullid
+        for node, content in zip(nodes, contents):
+            chain.append((filename, node, base, content))
+            base = node
+        return chain
 
     def createPack(self, revisions=None, packdir=None, version=0):
         if revisions is None:
@@ -62,17 +118,7 @@ class datapacktestsbase(object):
         if packdir is None:
             packdir = self.makeTempDir()
 
-        packer = revisionstore.mutabledeltastore(packfilepath=packdir)
-
-        for args in revisions:
-            filename, node, base, content = args[0:4]
-            # meta is optional
-            meta = None
-            if len(args) > 4:
-                meta = args[4]
-            packer.add(filename, node, base, content, metadata=meta)
-
-        path = packer.flush()
+        path = self.createPackNoReopen(revisions, packdir)
         return self.datapackreader(path)
 
     def _testAddSingle(self, content):
@@ -97,11 +143,11 @@ class datapacktestsbase(object):
         """Test putting multiple unrelated blobs into a pack and reading them
         out.
         """
+        contents = [b"abcdef%i" % i for i in range(10)]
+        nodes = self.getHashes(contents)
         revisions = []
-        for i in range(10):
+        for i, (content, node) in enumerate(zip(contents, nodes)):
             filename = "foo%s" % i
-            content = b"abcdef%i" % i
-            node = self.getHash(content)
             revisions.append((filename, node, nullid, content))
 
         pack = self.createPack(revisions)
@@ -114,11 +160,16 @@ class datapacktestsbase(object):
             self.assertEqual(content, chain[0][4])
 
     def testPackMetadata(self):
+        chunk = b"put-something-here \n"
+        contents = []
+        buf = bytearray()
+        for _ in range(100):
+            contents.append(bytes(buf))
+            buf.extend(chunk)
+        nodes = self.getHashes(contents)
         revisions = []
-        for i in range(100):
+        for i, (content, node) in enumerate(zip(contents, nodes)):
             filename = "%s.txt" % i
-            content = b"put-something-here \n" * i
-            node = self.getHash(content)
             meta = {constants.METAKEYFLAG: i ** 4, constants.METAKEYSIZE: len(content)}
             revisions.append((filename, node, nullid, content, meta))
         pack = self.createPack(revisions, version=1)
@@ -132,12 +183,12 @@ class datapacktestsbase(object):
     def testGetMissing(self):
         """Test the getmissing() api.
         """
+        contents = [b"abcdef%i" % i for i in range(10)]
+        nodes = self.getHashes(contents)
         revisions = []
         filename = "foo"
         lastnode = nullid
-        for i in range(10):
-            content = b"abcdef%i" % i
-            node = self.getHash(content)
+        for content, node in zip(contents, nodes):
             revisions.append((filename, node, lastnode, content))
             lastnode = node
 
@@ -166,8 +217,8 @@ class datapacktestsbase(object):
         pack = self.createPack()
         path = pack.path() + ".datapack"
         with open(path, "rb") as f:
-            raw = f.read()
-        raw = struct.pack("!B", 255) + raw[1:]
+            raw = bytearray(f.read())
+        raw[0] = 255
         os.chmod(path, os.stat(path).st_mode | stat.S_IWRITE)
         with open(path, "wb+") as f:
             f.write(raw)
@@ -188,21 +239,24 @@ class datapacktestsbase(object):
     def testLargePack(self):
         """Test creating and reading from a large pack with over X entries.
         This causes it to use a 2^16 fanout table instead."""
-        revisions = []
-        blobs = {}
         total = SMALLFANOUTCUTOFF + 1
-        for i in xrange(total):
-            filename = "filename-%s" % i
-            content = pycompat.encodeutf8(filename)
-            node = self.getHash(content)
-            blobs[(filename, node)] = content
-            revisions.append((filename, node, nullid, content))
+        prefix = "filename-"
+        filenames = [prefix + str(i) for i in xrange(total)]
+        contents = [pycompat.encodeutf8(filename) for filename in filenames]
+        nodes = self.getHashes(contents)
+        revisions = [
+            (filename, node, nullid, content)
+            for filename, node, content in zip(filenames, nodes, contents)
+        ]
 
         pack = self.createPack(revisions)
 
-        for (filename, node), content in pycompat.iteritems(blobs):
-            actualcontent = pack.getdeltachain(filename, node)[0][4]
-            self.assertEqual(actualcontent, content)
+        self.assertFalse(pack.getmissing(list(zip(filenames, nodes))))
+
+        # Spot check the contents of the first, middle and last blobs.
+        for i in (0, total // 2, total - 1):
+            actualcontent = pack.getdeltachain(filenames[i], nodes[i])[0][4]
+            self.assertEqual(actualcontent, contents[i])
 
     def testInlineRepack(self):
         """Verify that when fetchpacks is enabled, and the number of packfiles
@@ -214,15 +268,10 @@ class datapacktestsbase(object):
         numpacks = 20
         revisionsperpack = 100
 
-        for i in range(numpacks):
-            chain = []
-            revision = (str(i), self.getFakeHash(), nullid, b"content")
-
-            for _ in range(revisionsperpack):
-                chain.append(revision)
-                revision = (str(i), self.getFakeHash(), revision[1], self.getFakeHash())
-
-            self.createPack(chain, packdir)
+        chains = [
+            self.createFakeChain(str(i), revisionsperpack) for i in range(numpacks)
+        ]
+        self.createPacksNoReopen(chains, packdir)
 
         packreader = self.datapackreader
 
@@ -255,28 +304,16 @@ class datapacktestsbase(object):
         """Test that the pack store deletes corrupt packs."""
 
         packdir = self.makeTempDir()
-        deltachains = []
 
         numpacks = 5
         revisionsperpack = 100
 
-        firstpack = None
-        secondindex = None
-        for i in range(numpacks):
-            chain = []
-            revision = (str(i), self.getFakeHash(), nullid, b"content")
-
-            for _ in range(revisionsperpack):
-                chain.append(revision)
-                revision = (str(i), self.getFakeHash(), revision[1], self.getFakeHash())
-
-            pack = self.createPack(chain, packdir)
-            if firstpack is None:
-                firstpack = pack.packpath()
-            elif secondindex is None:
-                secondindex = pack.indexpath()
-
-            deltachains.append(chain)
+        deltachains = [
+            self.createFakeChain(str(i), revisionsperpack) for i in range(numpacks)
+        ]
+        paths = self.createPacksNoReopen(deltachains, packdir)
+        firstpack = self.datapackreader(paths[0]).packpath()
+        secondindex = self.datapackreader(paths[1]).indexpath()
 
         ui = uimod.ui()
         store = datapackstore(ui, packdir, True, deletecorruptpacks=True)
@@ -290,9 +327,7 @@ class datapacktestsbase(object):
 
         # Corrupt the pack
         os.chmod(firstpack, 0o644)
-        f = open(firstpack, "w")
-        f.truncate(1)
-        f.close()
+        truncate(firstpack, 1)
 
         # Re-create the store. Otherwise the behavior is kind of "undefined"
         # because the size of mmap-ed memory isn't truncated automatically,
@@ -316,9 +351,7 @@ class datapacktestsbase(object):
 
         # Corrupt the index
         os.chmod(secondindex, 0o644)
-        f = open(secondindex, "w")
-        f.truncate(1)
-        f.close()
+        truncate(secondindex, 1)
 
         # Load the packs
         origpackcount = len(os.listdir(packdir))
@@ -370,6 +403,33 @@ class datapacktestsbase(object):
         value = packer.getdeltachain(filename, node)
         self.assertEqual(value, [(filename, node, filename, base, content)])
 
+    def testAddMany(self):
+        """Test adding revisions with and without metadata in one add_many
+        call, and that a malformed revision rejects the whole batch."""
+        packdir = self.makeTempDir()
+        packer = revisionstore.mutabledeltastore(packfilepath=packdir)
+
+        meta = {constants.METAKEYFLAG: 1, constants.METAKEYSIZE: 4}
+        revisions = [
+            ("nometa", self.getFakeHash(), nullid, b"nometa"),
+            ("nonemeta", self.getFakeHash(), nullid, b"nonemeta", None),
+            ["withmeta", self.getFakeHash(), nullid, b"asdf", meta],
+        ]
+        packer.add_many(revisions)
+
+        for revision in revisions:
+            filename, node, base, content = revision[0:4]
+            expectedmeta = meta if filename == "withmeta" else {}
+            value = packer.getdelta(filename, node)
+            self.assertEqual(value, (content, filename, base, expectedmeta))
+
+        good = ("good", self.getFakeHash(), nullid, b"good")
+        bad = ("bad", self.getFakeHash(), nullid)
+        with self.assertRaises(ValueError):
+            packer.add_many([good, bad])
+        missing = packer.getmissing([good[0:2]])
+        self.assertEqual(missing, [good[0:2]])
+
     # perf test off by default since it's slow
     def _testIndexPerf(self):
         random.seed(0)
@@ -377,25 +437,32 @@ class datapacktestsbase(object):
         packsizes = [100, 10000, 100000, 500000, 1000000, 3000000]
         lookupsizes = [10, 100, 1000, 10000, 100000, 1000000]
         for packsize in packsizes:
-            revisions = []
-            for i in xrange(packsize):
-                filename = "filename-%s" % i
-                content = "content-%s" % i
-                node = self.getHash(content)
-                revisions.append((filename, node, nullid, content))
+            filenames = ["filename-" + str(i) for i in xrange(packsize)]
+            contents = [b"content-%d" % i for i in xrange(packsize)]
+            nodes = self.getHashes(contents)
+            revisions = [
+                (filename, node, nullid, content)
+                for filename, node, content in zip(filenames, nodes, contents)
+            ]
 
-            path = self.createPack(revisions).path()
+            pack = self.createPack(revisions)
+            findnodes = list(zip(filenames, nodes))
 
             # Perf of large multi-get
             import gc
 
+            # Move the revisions built above out of the collector's view, so
+            # no collection walks them during the timed lookups. gc.freeze()
+            # only exists on Python 3.7+.
+            canfreeze = hasattr(gc, "freeze")
+            gc.collect()
+            if canfreeze:
+                gc.freeze()
             gc.disable()
-            pack = self.datapackreader(path)
             for lookupsize in lookupsizes:
                 if lookupsize > packsize:
                     continue
-                random.shuffle(revisions)
-                findnodes = [(rev[0], rev[1]) for rev in revisions]
+                random.shuffle(findnodes)
 
                 start = time.time()
                 pack.getmissing(findnodes[:lookupsize])
@@ -410,6 +477,8 @@ class datapacktestsbase(object):
                 )
 
             print("")
+            if canfreeze:
+                gc.unfreeze()
             gc.enable()
 
         # The perf test is meant to produce output, so we always fail the test